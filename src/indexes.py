@@ -0,0 +1,396 @@
+"""Contains classes for building and reading the on-disk sidecar indexes used to speed
+up common queries."""
+from __future__ import print_function
+import os
+import sys
+import array
+import gzip
+import heapq
+import mmap
+import shutil
+import struct
+import tempfile
+import numpy
+
+# GEMINI genotype type codes (as stored in gt_types)
+HET = 1
+HOM_ALT = 3
+# Bit set in the carrier index flags when the sample's GT filter is PASS
+GT_PASS_BIT = 4
+
+
+def source_signature(path):
+    """Returns the (mtime, size) of a file, used to check whether an index built from
+    that file is still up to date"""
+    stat = os.stat(path)
+    return float(stat.st_mtime), int(stat.st_size)
+
+
+def native_string(value):
+    """Returns bytes read from an index or source file as a native string"""
+    return value if isinstance(value, str) else value.decode("utf-8")
+
+
+def normalise_chrom(chrom):
+    """Strips any chr prefix so 'chr1' and '1' match"""
+    return chrom[3:] if chrom.lower().startswith("chr") else chrom
+
+
+class CarrierIndex(object):
+    """Sparse variants x samples carrier matrix stored as a memory-mappable sidecar file
+    next to the database (<database>.carriers). The matrix is stored column-wise (one
+    column per sample), so the variants carried by a single sample can be read without
+    touching the genotype blobs in the database.
+
+    File layout (little endian):
+        header        - magic, number of samples, number of entries, database mtime
+                        and database size
+        sample names  - newline separated, length prefixed
+        column starts - (number of samples + 1) uint64 offsets into the entry arrays
+        variant ids   - one uint32 per entry
+        flags         - one uint8 per entry, the GEMINI genotype type (HET or HOM_ALT)
+                        with GT_PASS_BIT set if the sample's GT filter is PASS
+    """
+    MAGIC = b"GQCIDX01"
+    HEADER = struct.Struct("<8sIQdQ")
+
+    def __init__(self, database):
+        self.database = database
+        self.path = database + ".carriers"
+
+    def exists(self):
+        """Returns True if an index file is present for the database"""
+        return os.path.isfile(self.path)
+
+    def is_current(self):
+        """Returns True if the index exists and was built from the current database"""
+        if not self.exists():
+            return False
+        with open(self.path, 'rb') as index_file:
+            header = index_file.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            return False
+        magic, _, _, db_mtime, db_size = self.HEADER.unpack(header)
+        return magic == self.MAGIC and (db_mtime, db_size) == source_signature(self.database)
+
+    def build(self, geminidb):
+        """Scans every variant once and writes the carrier index for the database"""
+        signature = source_signature(self.database)
+        geminidb.run("SELECT variant_id, gt_types, gt_filters FROM variants")
+        idx_to_sample = dict((idx, smp) for smp, idx in geminidb.sample_to_idx.items())
+        sample_names = [idx_to_sample[idx] for idx in range(len(idx_to_sample))]
+        # Per sample arrays of carried variant ids and flags (compact, one uint32 and one
+        # uint8 per carrier)
+        columns = [(array.array('I'), array.array('B')) for _ in sample_names]
+        for row in geminidb:
+            gt_types = numpy.asarray(row["gt_types"])
+            gt_filters = row["gt_filters"]
+            variant_id = int(row["variant_id"])
+            for smpidx in numpy.flatnonzero((gt_types == HET) | (gt_types == HOM_ALT)):
+                flag = int(gt_types[smpidx])
+                if gt_filters is not None and gt_filters[smpidx] == "PASS":
+                    flag |= GT_PASS_BIT
+                columns[smpidx][0].append(variant_id)
+                columns[smpidx][1].append(flag)
+
+        # Writing to a temporary file first so a failed build never leaves a
+        # partial index that looks current
+        names_blob = '\n'.join(sample_names).encode("utf-8")
+        column_starts = numpy.zeros(len(columns) + 1, dtype="<u8")
+        column_starts[1:] = numpy.cumsum([len(variant_ids) for variant_ids, _ in columns])
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as index_file:
+                index_file.write(self.HEADER.pack(self.MAGIC, len(sample_names),
+                                                  int(column_starts[-1]),
+                                                  signature[0], signature[1]))
+                index_file.write(struct.pack("<Q", len(names_blob)))
+                index_file.write(names_blob)
+                column_starts.tofile(index_file)
+                for variant_ids, _ in columns:
+                    if sys.byteorder == "big":
+                        variant_ids.byteswap()
+                    variant_ids.tofile(index_file)
+                for _, flags in columns:
+                    flags.tofile(index_file)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return len(sample_names), int(column_starts[-1])
+
+    def sample_variants(self, sample):
+        """Returns the ids of the variants carried (HET or HOM_ALT) by the given sample,
+        reading only that sample's column of the index"""
+        with open(self.path, 'rb') as index_file:
+            index_map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                _, n_samples, _, _, _ = self.HEADER.unpack_from(index_map, 0)
+                offset = self.HEADER.size
+                names_length, = struct.unpack_from("<Q", index_map, offset)
+                offset += 8
+                sample_names = index_map[offset:offset + names_length].decode("utf-8").split('\n')
+                offset += names_length
+                try:
+                    smpidx = sample_names.index(sample)
+                except ValueError:
+                    raise KeyError("Sample {} not present in carrier index.".format(sample))
+                start, end = struct.unpack_from("<2Q", index_map, offset + 8 * smpidx)
+                ids_offset = offset + 8 * (n_samples + 1)
+                # tolist copies out of the map so it can be closed
+                return numpy.frombuffer(index_map, dtype="<u4", count=end - start,
+                                        offset=ids_offset + 4 * start).tolist()
+            finally:
+                index_map.close()
+
+
+class AnnotationIndex(object):
+    """Sorted, memory-mappable copy of an external annotation TSV (optionally gzipped)
+    stored next to it or in a given directory (<annotation>.<key>.gqidx). Rows are sorted
+    by (chrom, pos, ref, alt) for the 'position' key or by HGVS for the 'hgvs' key and
+    looked up by binary search, so query results can be annotated without loading the
+    file into memory.
+    Positions in the annotation file are expected to be 1-based (VCF style).
+
+    File layout (little endian):
+        header    - magic, number of rows, offset of the row offsets, source mtime
+                    and source size
+        columns   - the annotation file's header line
+        rows      - the annotation rows in key order
+        offsets   - one uint64 file offset per row
+    """
+    MAGIC = b"GQAIDX01"
+    HEADER = struct.Struct("<8sQQdQ")
+    # Rows sorted in memory at a time while building, sorted runs are then merged
+    CHUNK_ROWS = 500000
+    # Maximum number of sorted runs open at once while merging
+    MERGE_FAN_IN = 64
+    # Candidate annotation file column names for each part of the key
+    KEY_COLUMNS = {
+        "position": (("chrom", "chr", "chromosome"),
+                     ("pos", "position", "start"),
+                     ("ref",),
+                     ("alt",)),
+        "hgvs": (("hgvs", "hgvsc", "vep_hgvsc"),)
+    }
+    # Query fields used to look up each row of the query results
+    QUERY_FIELDS = {
+        "position": ("chrom", "start", "ref", "alt"),
+        "hgvs": ("vep_hgvsc",)
+    }
+
+    def __init__(self, source, key="position", index_dir=None):
+        if key not in self.KEY_COLUMNS:
+            raise ValueError("Unknown annotation key: {}".format(key))
+        self.source = source
+        self.key = key
+        # Stored next to the annotation file unless another directory is given
+        index_name = "{source}.{key}.gqidx".format(source=os.path.basename(source), key=key)
+        if index_dir is None:
+            index_dir = os.path.dirname(os.path.abspath(source))
+        self.path = os.path.join(index_dir, index_name)
+        self.columns = None
+        self.key_idx = None
+        self._map = None
+        self._n_rows = 0
+        self._offsets_start = 0
+
+    def is_current(self):
+        """Returns True if the index exists and was built from the current annotation file"""
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as index_file:
+            header = index_file.read(self.HEADER.size)
+        if len(header) != self.HEADER.size:
+            return False
+        magic, _, _, src_mtime, src_size = self.HEADER.unpack(header)
+        return magic == self.MAGIC and (src_mtime, src_size) == source_signature(self.source)
+
+    def _set_columns(self, header_line):
+        """Stores the annotation column names and finds the key columns among them"""
+        self.columns = native_string(header_line).rstrip('\r\n').lstrip('#').split('\t')
+        lower_columns = [column.lower() for column in self.columns]
+        self.key_idx = []
+        for candidates in self.KEY_COLUMNS[self.key]:
+            matches = [lower_columns.index(c) for c in candidates if c in lower_columns]
+            if not matches:
+                raise ValueError("Annotation file has no {} column.".format(candidates[0]))
+            self.key_idx.append(matches[0])
+
+    def _make_key(self, values):
+        """Returns the sort key for a list of key values"""
+        if self.key == "position":
+            return (normalise_chrom(values[0]), int(values[1]), values[2], values[3])
+        return tuple(values)
+
+    def _row_key(self, line):
+        """Returns the sort key of a raw annotation row"""
+        fields = native_string(line).rstrip('\r\n').split('\t')
+        return self._make_key([fields[idx] for idx in self.key_idx])
+
+    def _write_run(self, rows, tmp_dir):
+        """Sorts a chunk of rows and writes it to a temporary run file"""
+        rows.sort()
+        run_file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        with run_file:
+            for _, line in rows:
+                run_file.write(line)
+        return run_file.name
+
+    def _read_run(self, run_path):
+        """Yields (key, row) pairs from a sorted run file"""
+        with open(run_path, 'rb') as run_file:
+            for line in run_file:
+                yield self._row_key(line), line
+
+    def _merge_runs(self, run_paths, tmp_dir):
+        """Merges sorted runs in passes of at most MERGE_FAN_IN runs until few enough
+        remain to be merged in one go, returns the remaining run paths"""
+        while len(run_paths) > self.MERGE_FAN_IN:
+            merged_paths = []
+            for group_start in range(0, len(run_paths), self.MERGE_FAN_IN):
+                group = run_paths[group_start:group_start + self.MERGE_FAN_IN]
+                run_file = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+                with run_file:
+                    runs = [self._read_run(run_path) for run_path in group]
+                    for _, line in heapq.merge(*runs):
+                        run_file.write(line)
+                for run_path in group:
+                    os.remove(run_path)
+                merged_paths.append(run_file.name)
+            run_paths = merged_paths
+        return run_paths
+
+    def build(self):
+        """Sorts the annotation file into the index with an external merge sort, so only
+        CHUNK_ROWS rows are held in memory at a time"""
+        signature = source_signature(self.source)
+        opener = gzip.open if self.source.endswith(".gz") else open
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(self.path))
+        tmp_path = self.path + ".tmp"
+        try:
+            # Writing sorted runs of rows
+            run_paths = []
+            with opener(self.source, 'rb') as source_file:
+                # Skipping any ## meta lines above the header
+                header_line = source_file.readline()
+                line_number = 1
+                while header_line.startswith(b"##"):
+                    header_line = source_file.readline()
+                    line_number += 1
+                self._set_columns(header_line)
+                n_key_fields = max(self.key_idx) + 1
+                rows = []
+                for line_number, line in enumerate(source_file, line_number + 1):
+                    if not line.strip():
+                        continue
+                    if not line.endswith(b"\n"):
+                        line += b"\n"
+                    if line.count(b"\t") + 1 < n_key_fields:
+                        raise ValueError("Annotation file line {n} has fewer columns than "
+                                         "the key needs.".format(n=line_number))
+                    try:
+                        row_key = self._row_key(line)
+                    except ValueError:
+                        raise ValueError("Annotation file line {n} has a non-integer "
+                                         "position.".format(n=line_number))
+                    rows.append((row_key, line))
+                    if len(rows) >= self.CHUNK_ROWS:
+                        run_paths.append(self._write_run(rows, tmp_dir))
+                        rows = []
+                if rows:
+                    run_paths.append(self._write_run(rows, tmp_dir))
+
+            # Merging the runs into the index, recording the offset of each row
+            run_paths = self._merge_runs(run_paths, tmp_dir)
+            offsets_path = os.path.join(tmp_dir, "offsets")
+            n_rows = 0
+            with open(tmp_path, 'wb') as index_file:
+                index_file.write(self.HEADER.pack(self.MAGIC, 0, 0, signature[0], signature[1]))
+                index_file.write(header_line.rstrip(b"\r\n") + b"\n")
+                runs = [self._read_run(run_path) for run_path in run_paths]
+                with open(offsets_path, 'wb') as offsets_file:
+                    for _, line in heapq.merge(*runs):
+                        offsets_file.write(struct.pack("<Q", index_file.tell()))
+                        index_file.write(line)
+                        n_rows += 1
+                offsets_start = index_file.tell()
+                with open(offsets_path, 'rb') as offsets_input:
+                    shutil.copyfileobj(offsets_input, index_file)
+                index_file.seek(0)
+                index_file.write(self.HEADER.pack(self.MAGIC, n_rows, offsets_start,
+                                                  signature[0], signature[1]))
+            os.rename(tmp_path, self.path)
+        finally:
+            shutil.rmtree(tmp_dir)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return n_rows
+
+    def open(self):
+        """Memory maps the index for lookups"""
+        with open(self.path, 'rb') as index_file:
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        _, self._n_rows, self._offsets_start, _, _ = self.HEADER.unpack_from(self._map, 0)
+        header_end = self._map.find(b"\n", self.HEADER.size)
+        self._set_columns(self._map[self.HEADER.size:header_end])
+
+    def close(self):
+        """Closes the memory mapped index"""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _row(self, row_idx):
+        """Returns the raw row at the given position in the sorted index"""
+        start, = struct.unpack_from("<Q", self._map, self._offsets_start + 8 * row_idx)
+        return self._map[start:self._map.find(b"\n", start)]
+
+    def lookup(self, values):
+        """Returns the annotation row (as a list of fields) matching the given key values,
+        or None if there is no match"""
+        key = self._make_key(values)
+        low, high = 0, self._n_rows
+        while low < high:
+            mid = (low + high) // 2
+            if self._row_key(self._row(mid)) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._n_rows:
+            row = self._row(low)
+            if self._row_key(row) == key:
+                return native_string(row).rstrip('\r').split('\t')
+        return None
+
+    def annotate_lines(self, table_lines, fields=None):
+        """Takes query output lines (header first) and yields them with the given annotation
+        fields (all non-key fields by default) appended, joining on the QUERY_FIELDS"""
+        if fields is None:
+            fields = [column for idx, column in enumerate(self.columns)
+                      if idx not in self.key_idx]
+        missing = [field for field in fields if field not in self.columns]
+        if missing:
+            raise ValueError("Fields not in annotation file: {}.".format(', '.join(missing)))
+        field_idx = [self.columns.index(field) for field in fields]
+        lines = iter(table_lines)
+        header = next(lines)
+        header_fields = header.split('\t')
+        missing = [field for field in self.QUERY_FIELDS[self.key] if field not in header_fields]
+        if missing:
+            raise ValueError("Query output is missing fields needed to join annotations: "
+                             "{}.".format(', '.join(missing)))
+        query_idx = [header_fields.index(field) for field in self.QUERY_FIELDS[self.key]]
+        yield header + '\t' + '\t'.join(fields)
+        for line in lines:
+            line_fields = line.split('\t')
+            values = [line_fields[idx] for idx in query_idx]
+            if self.key == "position":
+                # GEMINI start is 0-based, annotation positions are 1-based
+                values[1] = int(values[1]) + 1
+            row = self.lookup(values)
+            if row is None:
+                annotations = ["None"] * len(field_idx)
+            else:
+                annotations = [row[idx] if idx < len(row) else "None" for idx in field_idx]
+            yield line + '\t' + '\t'.join(annotations)
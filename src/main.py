@@ -1,8 +1,11 @@
 """Contains primary functions for each mode and the main() function."""
 from __future__ import print_function
+import os
 import argparse
+import itertools
 import re
 import classes
+import indexes
 from gemini import GeminiQuery  # Importing the gemini query class
 
 
@@ -72,6 +75,14 @@ def get_sample_variants(geminidb, args, options):
                     "gt_types.{fullsampleid} == HOM_ALT".format(fullsampleid=fullsampleid)
     genotype_information = "gts.{fsi}, gt_ref_depths.{fsi}, gt_alt_depths.{fsi}, " \
                            "gt_alt_freqs.{fsi}".format(fsi=fullsampleid)
+    # Using the carrier index (if built and up to date) to avoid scanning every genotype
+    carrier_index = indexes.CarrierIndex(args["input"])
+    if carrier_index.is_current():
+        return get_indexed_sample_variants(geminidb, args, options, carrier_index,
+                                           fullsampleid, genotype_information)
+    elif carrier_index.exists():
+        print("Carrier index is out of date, falling back to a full scan. Rerun " \
+              "build-carrier-index to update it.")
     query = "SELECT {fields}, {genotypeinfo} FROM variants WHERE {where_filter}" \
                 .format(fields=options.query_fields(),
                         where_filter=options.query_filter(),
@@ -87,6 +98,102 @@ def get_sample_variants(geminidb, args, options):
     return table_lines
 
 
+def get_indexed_sample_variants(geminidb, args, options, carrier_index, fullsampleid,
+                                genotype_information):
+    """Returns a table of variants present in a given sample, using the carrier index to
+    fetch only the rows carried by that sample"""
+    print("Using carrier index: {}".format(carrier_index.path))
+    try:
+        variant_ids = carrier_index.sample_variants(fullsampleid)
+    except KeyError:
+        print("Sample not found in carrier index, exiting.")
+        quit()
+    print("Found {} variants carried by the sample.".format(len(variant_ids)))
+    # The filter is bracketed so any OR in it can't escape the variant_id restriction
+    query_base = "SELECT {fields}, {genotypeinfo} FROM variants WHERE ({where_filter}) " \
+                 "AND variant_id IN ".format(fields=options.query_fields(),
+                                             where_filter=options.query_filter(),
+                                             genotypeinfo=genotype_information)
+    print("Generating a table from the following query restricted to the variants " \
+          "carried by the given sample:")
+    print(query_base + "(<{} carried variant ids>)".format(len(variant_ids)))
+    # Fetching the rows in chunks to keep the IN lists within SQLite's limits
+    chunk_size = 10000
+    table_lines = []
+    for chunk_start in range(0, max(len(variant_ids), 1), chunk_size):
+        id_list = ', '.join(str(vid) for vid in
+                            variant_ids[chunk_start:chunk_start + chunk_size])
+        query = query_base + "(" + id_list + ")"
+        if args["show_query"]:
+            print(query)
+        geminidb.run(query, show_variant_samples=args["hidesamples"])
+        if not table_lines:
+            table_lines.append(str(geminidb.header))
+        for row in geminidb:
+            table_lines.append(str(row))
+    return table_lines
+
+
+def build_carrier_index(geminidb, args):
+    """Builds the sample to variant carrier index sidecar for the given database"""
+    carrier_index = indexes.CarrierIndex(args["input"])
+    print("Building carrier index: {}".format(carrier_index.path))
+    n_samples, n_entries = carrier_index.build(geminidb)
+    print("Indexed {entries} carrier genotypes across {samples} samples." \
+              .format(entries=n_entries, samples=n_samples))
+
+
+def open_annotation_index(args):
+    """Returns the opened index for the external annotation file, building it first if it
+    is missing or out of date. The index is kept next to the annotation file unless
+    another directory is given, or the annotation file's directory is not writable in
+    which case the output directory is used."""
+    annotation_index = indexes.AnnotationIndex(args["annotate"], args["annotate_key"],
+                                               args["annotate_index_dir"])
+    try:
+        if not annotation_index.is_current() and args["annotate_index_dir"] is None and \
+                not os.access(os.path.dirname(annotation_index.path), os.W_OK):
+            output_dir = os.path.dirname(os.path.abspath(args["output"]))
+            print("Annotation file directory is not writable, using {} for the " \
+                  "annotation index.".format(output_dir))
+            annotation_index = indexes.AnnotationIndex(args["annotate"],
+                                                       args["annotate_key"], output_dir)
+        if not annotation_index.is_current():
+            print("Building annotation index: {}".format(annotation_index.path))
+            n_rows = annotation_index.build()
+            print("Indexed {} annotation rows.".format(n_rows))
+        annotation_index.open()
+    except ValueError as exc:
+        print("{} Exiting.".format(exc))
+        quit()
+    except (IOError, OSError) as exc:
+        print("Could not build or open the annotation index: {}. Exiting.".format(exc))
+        quit()
+    return annotation_index
+
+
+def write_table(table_lines, args):
+    """Writes the output table, joining any external annotations onto it while streaming"""
+    annotation_index = None
+    if args["annotate"]:
+        annotation_index = open_annotation_index(args)
+        fields = args["annotate_fields"].split(',') if args["annotate_fields"] else None
+        try:
+            # Checks the fields and query output header before anything is written
+            table_lines = annotation_index.annotate_lines(table_lines, fields)
+            first_line = next(table_lines)
+        except ValueError as exc:
+            print("{} Exiting.".format(exc))
+            quit()
+        table_lines = itertools.chain([first_line], table_lines)
+    try:
+        with open(args["output"], 'w') as outputfile:
+            for line_number, line in enumerate(table_lines):
+                outputfile.write(line if line_number == 0 else '\n' + line)
+    finally:
+        if annotation_index is not None:
+            annotation_index.close()
+
 
 def get_variant_information(geminidb, args, options):
     # Getting the list of variants (or one, doesn't matter I think)
@@ -162,7 +269,20 @@ def parse_arguments():
         "genes"          : "List of genes to include. If not specified will include all",
         "partial"        : "Flag. Allow partial matching of variants.",
         "filtersamples"  : "Flag. Filter sample lists to only include GT filter PASS.",
-        "show_query"     : "Flag. Prints the query run."
+        "show_query"     : "Flag. Prints the query run.",
+        "annotate"       : "Annotation TSV (optionally gzipped) to join onto the output. "    \
+                           "A sorted index is built next to it on first use.",
+        "annotate_key"   : "Key used to join annotations. One of: position (chrom, pos, "     \
+                           "ref, alt columns, 1-based positions); hgvs (HGVS c. column "      \
+                           "matched against vep_hgvsc).",
+        "annotate_index" : "Directory to store the annotation index in. Defaults to the "    \
+                           "annotation file's directory, or the output directory if that "    \
+                           "is not writable.",
+        "annotate_fields": "Comma separated list of annotation file columns to add. If not "  \
+                           "specified will add all non-key columns.",
+        "carrier_index"  : "Builds a sparse sample to variant carrier index next to the "   \
+                           "database (<database>.carriers). Sample mode uses the index "     \
+                           "when it is present and up to date."
     }
     # Defining the argument parser
     # Top level parser
@@ -208,6 +328,19 @@ def parse_arguments():
     shared_arguments.add_argument("--show_query",
                                   help=helptext_dict["show_query"],
                                   action="store_true")
+    shared_arguments.add_argument("--annotate",
+                                  help=helptext_dict["annotate"],
+                                  default=None)
+    shared_arguments.add_argument("--annotate_key",
+                                  help=helptext_dict["annotate_key"],
+                                  choices=["position", "hgvs"],
+                                  default="position")
+    shared_arguments.add_argument("--annotate_index_dir",
+                                  help=helptext_dict["annotate_index"],
+                                  default=None)
+    shared_arguments.add_argument("--annotate_fields",
+                                  help=helptext_dict["annotate_fields"],
+                                  default=None)
     # Below are manual options that will override defaults
     shared_arguments.add_argument("-f", "--filter", help=helptext_dict["filter"], default=None)
     shared_arguments.add_argument("-F", "--fields", help=helptext_dict["fields"], default=None)
@@ -247,6 +380,10 @@ def parse_arguments():
     parser_info = subparsers.add_parser("info",
                                         help=helptext_dict["info"],
                                         parents=[shared_arguments])
+    # Build carrier index
+    parser_carrier_index = subparsers.add_parser("build-carrier-index",
+                                                 help=helptext_dict["carrier_index"],
+                                                 parents=[shared_arguments])
 
     arguments = vars(parser.parse_args())  # Parsing the arguments and storing as a dictionary
 
@@ -270,20 +407,19 @@ def main():
     # Calling relevant function depending on the chosen mode
     if arguments["mode"] == "sample":
         output_table = get_sample_variants(gemini_db, arguments, queryformatter)
-        with open(arguments["output"], 'w') as outputfile:
-            outputfile.write('\n'.join(output_table))
+        write_table(output_table, arguments)
     elif arguments["mode"] == "variant":
         output_table = get_variant_information(gemini_db, arguments, queryformatter)
-        with open(arguments["output"], 'w') as outputfile:
-            outputfile.write('\n'.join(output_table))
+        write_table(output_table, arguments)
     elif arguments["mode"] == "table":
         output_table = get_table(gemini_db, arguments, queryformatter)
-        with open(arguments["output"], 'w') as outputfile:
-            outputfile.write('\n'.join(output_table))
+        write_table(output_table, arguments)
     elif arguments["mode"] == "info":
         print_comprehension = [
             print(field) for field in get_fields(gemini_db).split('\t')
         ]
+    elif arguments["mode"] == "build-carrier-index":
+        build_carrier_index(gemini_db, arguments)
 
 
 if __name__ == "__main__":